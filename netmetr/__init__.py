@@ -4,5 +4,15 @@ netmetr client package
 
 __version__ = "2.0.2"
 
-from .netmetr import Netmetr  # noqa: F401
 from .exceptions import NetmetrError  # noqa: F401
+
+
+def __getattr__(name):
+    # Netmetr pulls in the whole client (ssl, http.client, ...), so it is
+    # imported on the first use only - e.g. autostart checks that exit
+    # immediately do not need it at all
+    if name == "Netmetr":
+        from .netmetr import Netmetr
+        globals()["Netmetr"] = Netmetr
+        return Netmetr
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -5,7 +5,6 @@ from . import __version__
 from .argparser import get_arg_parser
 from .exceptions import NetmetrError
 from .logging import logger
-from .netmetr import Netmetr
 from .protocols import Mode, get_proto_mode
 from .config import make_default_config
 
@@ -14,8 +13,9 @@ def is_time_to_run(hours_to_run):
     if not hours_to_run:
         return False
 
-    hours = tuple(map(int, hours_to_run))
-    return datetime.datetime.now().hour in hours
+    # the config values may be both ints and strings
+    current_hour = datetime.datetime.now().hour
+    return any(int(hour) == current_hour for hour in hours_to_run)
 
 
 def main():
@@ -44,6 +44,9 @@ def main():
         logger.debug(f"Autostarted, sleeping {config['autostart_delay']}s before run.")
         time.sleep(int(config["autostart_delay"]))
 
+    # imported only when really needed, see netmetr/__init__.py
+    from .netmetr import Netmetr
+
     netmetr = Netmetr(
         args.control_server or config["control_server"],
         unsecure=args.unsecure_connection,
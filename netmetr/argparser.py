@@ -1,8 +1,10 @@
 import argparse
+import functools
 
 from . import __version__
 
 
+@functools.lru_cache(maxsize=1)
 def get_arg_parser():
     parser = argparse.ArgumentParser(
             description="NetMetr - client"
@@ -1,13 +1,15 @@
-import calendar
+import base64
+import collections.abc
 import contextlib
+import functools
+import http.client
 import json
 import locale
 import ssl
-import subprocess
 import time
 
-from urllib import request
 import urllib.parse
+import urllib.request
 
 from . import __version__
 from .exceptions import ControlServerError
@@ -16,6 +18,13 @@ from .protocols import Protocol
 
 CLIENT_SW_VERSION = "Python netmetr client v{}".format(__version__)
 DEFAULT_LANG = "en_US"
+JSON_SEPARATORS = (",", ":")
+STREAM_CHUNK_SIZE = 16384
+REQUEST_HEADERS = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+    "User-Agent": "netmetr/{}".format(__version__),
+}
 
 
 class ControlServer:
@@ -26,15 +35,23 @@ class ControlServer:
         self.address = self.url_dual
         self.uuid = uuid
         self.use_tls = use_tls
+        self.scheme = "https" if self.use_tls else "http"
+
+        # Connections are kept open and reused by all the requests sent to
+        # the same host, so the TCP and TLS handshakes are done only once
+        self._connections = {}
 
         self.language = get_default_language()
-        self.timezone = subprocess.check_output([
-            "date",
-            "+%Z"
-        ])[:-1].decode()
+        self.timezone = get_timezone()
 
         self._load_uuid()
 
+    def close(self):
+        """Close all the kept-alive connections"""
+        for conn, _, _ in self._connections.values():
+            conn.close()
+        self._connections.clear()
+
     def _load_uuid(self):
         if not self.uuid:
             logger.warning("Uuid not found, requesting new one.")
@@ -76,12 +93,10 @@ class ControlServer:
     def request_settings(self):
         logger.progress("Requesting test config from the control server...")
         req = {
+            **self._client_fields(),  # language optional, timezone & uuid required
             "client": "HW-PROBE",  # required, values: "HW-PROBE", "RMBT", etc
-            "language": self.language,  # optional
             "time": get_time(),  # required
-            "timezone": self.timezone,  # required
             "type": "DESKTOP",  # required, client type, values: "DESKTOP", "MOBILE"
-            "uuid": self.uuid,  # required
             "version": "0.1",  # required, test version?, values: "0.1"
         }
         url = self.create_url("testRequest")
@@ -105,8 +120,12 @@ class ControlServer:
         url = self.create_url("result")
         logger.log_request(req, url, msg="(speed detail omitted)")
 
+        if speed_array is not None:
+            # the samples are converted one by one while being sent, the
+            # streamed upload is never resent (see _post())
+            speed_array = (sample._asdict() for sample in speed_array)
         req["speed_detail"] = speed_array
-        rep = self.send_request(req, url)
+        rep = self.send_request(req, url, stream=True)
         logger.log_response(rep)
 
     def download_history(self, log_count):
@@ -115,10 +134,8 @@ class ControlServer:
         """
 
         req = {
-            "language": self.language,
-            "timezone": self.timezone,
+            **self._client_fields(),
             "result_limit": str(log_count),
-            "uuid": self.uuid,
         }
 
         logger.debug("Download measurement history from the control server.")
@@ -134,11 +151,7 @@ class ControlServer:
         synchronization code that can be used to view saved measurements from
         different devices. The new code is saved via uci.
         """
-        req = {
-            "language": self.language,
-            "timezone": self.timezone,
-            "uuid": self.uuid,
-        }
+        req = self._client_fields()
 
         logger.debug("Download sync code from the control server.")
         url = self.create_url("sync")
@@ -151,34 +164,45 @@ class ControlServer:
             return sync_code
         raise ControlServerError("Failed to download the sync code - empty response")
 
-    def send_request(self, payload, url):
-        req = request.Request(url)
-        req.add_header("Accept", "application/json")
-        req.add_header("Content-Type", "application/json")
-        data = json.dumps(payload)
+    def _client_fields(self):
+        """Return the client identification shared by most of the requests"""
+        return {
+            "language": self.language,
+            "timezone": self.timezone,
+            "uuid": self.uuid,
+        }
 
-        ctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-        ctx.verify_mode = ssl.CERT_REQUIRED
-        ctx.set_default_verify_paths()
+    def send_request(self, payload, url, stream=False):
+        """Send the payload to the control server and return its response.
 
+        With stream set, the payload is serialized piece by piece while it is
+        sent (using chunked transfer encoding), so the whole serialized
+        payload is never held in memory.
+        """
         try:
-            resp = request.urlopen(req, data.encode(), context=ctx)
+            status, body = self._post(url, payload, stream)
 
-        except urllib.error.HTTPError as e:
+        except (http.client.HTTPException, OSError) as e:
             raise ControlServerError(
                 "Failed to contact the control server. "
-                "This may be caused by poor internet connection or server "
-                "overload - please try again later."
+                "This may be caused by poor internet connection or wrong "
+                "server address - please check it and try again later."
             ) from e
 
-        except urllib.error.URLError as e:
+        if status >= 400:
             raise ControlServerError(
                 "Failed to contact the control server. "
-                "This may be caused by poor internet connection or wrong "
-                "server address - please check it and try again later."
-            ) from e
+                "This may be caused by poor internet connection or server "
+                "overload - please try again later."
+            )
+        if status >= 300:
+            # redirects are not followed (see _post())
+            raise ControlServerError(
+                "Unexpected control server response (HTTP {}) - please check "
+                "the server address.".format(status)
+            )
 
-        rep = json.loads(resp.read().decode("utf-8"))
+        rep = json.loads(body)
         if rep.get("error"):
             raise ControlServerError("Control server response contains error: {}".format(
                 rep["error"]
@@ -186,20 +210,182 @@ class ControlServer:
 
         return rep
 
-    def create_url(self, path, query_params={}):
-        url = "{}://{}/RMBTControlServer/{}".format(
-                "https" if self.use_tls else "http",
-                self.address,
-                path
-        )
-        params = urllib.parse.urlencode(query_params)
-        return "?".join([url, params]) if params else url
+    def _post(self, url, payload, stream):
+        """Send the payload using a kept-alive connection to the url host and
+        return status code and body of the response. Redirects are not
+        followed.
+        """
+        parsed = urllib.parse.urlsplit(url)
+        path = "?".join([parsed.path, parsed.query]) if parsed.query else parsed.path
+
+        # The streamed result upload is sent after the whole measurement, the
+        # connection would be idle for too long by then. It cannot be simply
+        # retried either (see below), so it always gets a new connection.
+        connection = None if stream else self._connections.get(parsed.netloc)
+        reused = connection is not None
+        if not reused:
+            previous = self._connections.pop(parsed.netloc, None)
+            if previous is not None:
+                previous[0].close()
+            connection = self._connect(parsed.scheme, parsed.netloc)
+            self._connections[parsed.netloc] = connection
+        conn, headers, absolute_url = connection
+        if absolute_url:
+            path = url
+
+        # The server may close an idle kept-alive connection, the request is
+        # retried once with a new one in such case
+        retry = reused
+        try:
+            while True:
+                try:
+                    conn.request("POST", path, body=encode_payload(payload, stream),
+                                 headers=headers)
+                except (ConnectionResetError, BrokenPipeError):
+                    # not (completely) sent, safe to send again
+                    if not retry:
+                        raise
+                    retry = False
+                    conn.close()
+                    continue
+
+                try:
+                    resp = conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError):
+                    # The request may have been processed already, which is
+                    # fine for all but the result upload (single use test
+                    # token) - and that one is never sent over a reused
+                    # connection.
+                    if not retry:
+                        raise
+                    retry = False
+                    conn.close()
+                    continue
+
+                return resp.status, resp.read()
+
+        except Exception:
+            # never leave a partially sent request on a cached connection
+            conn.close()
+            raise
+
+    def _connect(self, scheme, netloc):
+        """Create a connection to the host - through a proxy if one is set
+        by the environment (http_proxy, https_proxy, no_proxy) as urllib does.
+
+        Return the connection, headers to send with each request and whether
+        the request target has to be the absolute url (plain HTTP proxy).
+        """
+        proxy = get_proxy(scheme, netloc)
+        if scheme == "https":
+            if proxy is None:
+                return http.client.HTTPSConnection(netloc, context=get_ssl_context()), REQUEST_HEADERS, False
+            proxy_netloc, proxy_headers = proxy
+            conn = http.client.HTTPSConnection(proxy_netloc, context=get_ssl_context())
+            conn.set_tunnel(netloc, headers=proxy_headers)
+            return conn, REQUEST_HEADERS, False
+
+        if proxy is None:
+            return http.client.HTTPConnection(netloc), REQUEST_HEADERS, False
+        proxy_netloc, proxy_headers = proxy
+        return http.client.HTTPConnection(proxy_netloc), {**REQUEST_HEADERS, **proxy_headers}, True
+
+    def create_url(self, path, query_params=None):
+        url = f"{self.scheme}://{self.address}/RMBTControlServer/{path}"
+        if not query_params:
+            return url
+        return f"{url}?{urllib.parse.urlencode(query_params)}"
 
 
 def get_time() -> int:
-    return int(round(calendar.timegm(time.gmtime())*1000))
+    return time.time_ns() // 1000000
+
+
+def encode_payload(payload, stream=False):
+    """Serialize the payload to JSON bytes. With stream set, return an
+    iterator of chunks of about STREAM_CHUNK_SIZE bytes instead.
+    """
+    if not stream:
+        return json.dumps(payload, separators=JSON_SEPARATORS).encode()
+    return _iter_json_chunks(payload)
+
+
+def _iter_json_chunks(payload):
+    parts = []
+    size = 0
+    for part in _iter_json_parts(payload):
+        parts.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(parts).encode()
+            parts = []
+            size = 0
+    if parts:
+        yield "".join(parts).encode()
+
+
+def _iter_json_parts(payload):
+    """Encode the payload like JSONEncoder.iterencode. Iterators among the
+    values of the payload (e.g. generators) are encoded as arrays item by
+    item, without collecting them into a list first.
+    """
+    encoder = json.JSONEncoder(separators=JSON_SEPARATORS)
+    if not isinstance(payload, dict):
+        yield from encoder.iterencode(payload)
+        return
+
+    yield "{"
+    for i, (key, value) in enumerate(payload.items()):
+        yield "{}{}:".format("," if i else "", encoder.encode(str(key)))
+        if isinstance(value, collections.abc.Iterator):
+            yield "["
+            for j, item in enumerate(value):
+                if j:
+                    yield ","
+                yield from encoder.iterencode(item)
+            yield "]"
+        else:
+            yield from encoder.iterencode(value)
+    yield "}"
+
+
+def get_proxy(scheme, netloc):
+    """Return the proxy address and the headers authenticating to it, or None
+    if no proxy is to be used for the host.
+    """
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(netloc):
+        return None
+
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    parsed = urllib.parse.urlsplit(proxy)
+    headers = {}
+    if parsed.username is not None:
+        credentials = "{}:{}".format(
+            urllib.parse.unquote(parsed.username),
+            urllib.parse.unquote(parsed.password or "")
+        )
+        headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode()).decode()
+    return parsed.netloc.rpartition("@")[2], headers
+
+
+def get_timezone():
+    """Return the current timezone abbreviation - the same as `date +%Z`"""
+    return time.strftime("%Z")
+
+
+@functools.lru_cache(maxsize=1)
+def get_ssl_context():
+    """Create the SSL context once per process - loading the CA certificates
+    is expensive and they are the same for all the requests.
+    """
+    ctx = ssl.create_default_context()
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    return ctx
 
 
+@functools.lru_cache(maxsize=1)
 def get_default_language():
     lang = locale.getdefaultlocale()[0]
     return (lang if lang else DEFAULT_LANG)
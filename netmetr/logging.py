@@ -1,6 +1,11 @@
 import json
 import logging
-import logging.handlers
+import sys
+
+COLOR_YELLOW = "\033[93m"
+COLOR_RED = "\033[91m"
+COLOR_RED_BG = "\033[41m"
+COLOR_RESET = "\033[0m"
 
 
 class Logger():
@@ -31,10 +36,7 @@ class Logger():
         """ Colored & enabled by default (parsed by foris) but treated like debug
             by sys logger
         """
-        if self.colored:
-            self._print("\033[93m" + msg + "\033[0m")
-        else:
-            self._print(msg)
+        self._print_colored(COLOR_YELLOW, msg)
 
         if self.logger:
             self.logger.debug(msg)
@@ -49,28 +51,19 @@ class Logger():
             self.logger.debug(msg)
 
     def info(self, msg):
-        if self.colored:
-            self._print("\033[91m" + msg + "\033[0m")
-        else:
-            self._print(msg)
+        self._print_colored(COLOR_RED, msg)
 
         if self.logger:
             self.logger.info(msg)
 
     def warning(self, msg):
-        if self.colored:
-            self._print("\033[91m" + msg + "\033[0m")
-        else:
-            self._print(msg)
+        self._print_colored(COLOR_RED, msg)
 
         if self.logger:
             self.logger.warning(msg)
 
     def error(self, msg):
-        if self.colored:
-            self._print("\033[41mERROR: " + msg + "\033[0m")
-        else:
-            self._print("ERROR: {}".format(msg))
+        self._print_colored(COLOR_RED_BG, f"ERROR: {msg}")
 
         if self.logger:
             self.logger.error(msg)
@@ -78,10 +71,11 @@ class Logger():
     def log_request(self, req, url, msg=""):
         if self.lvl_debug:
             self._print_debug(
-                "Sending the following request to {}\n{}".format(url, msg),
+                f"Sending the following request to {url}\n{msg}",
                 detail=json.dumps(req, indent=2)
             )
-        if self.logger:
+        # do not serialize the request unless it is really logged
+        if self.logger and self.logger.isEnabledFor(logging.DEBUG):
             self.logger.debug(
                 "Sending the following request to %s %s: %s", url, msg,
                 json.dumps(req)
@@ -90,7 +84,7 @@ class Logger():
     def log_response(self, resp):
         if self.lvl_debug:
             self._print_debug("response:", detail=json.dumps(resp, indent=2))
-        if self.logger:
+        if self.logger and self.logger.isEnabledFor(logging.DEBUG):
             self.logger.debug("Response: %s", json.dumps(resp))
 
     def log_result(self, result):
@@ -98,15 +92,18 @@ class Logger():
             self._print_debug("Speed test result:", detail=result)
 
     def _print_debug(self, msg, detail):
+        self._print_colored(COLOR_YELLOW, msg)
+        self._print(detail)
+
+    def _print_colored(self, color, msg):
         if self.colored:
-            self._print("\033[93m" + msg + "\033[0m")
+            self._print(f"{color}{msg}{COLOR_RESET}")
         else:
             self._print(msg)
-        self._print(detail)
 
     def _print(self, msg):
         if not self.quiet:
-            print(msg)
+            sys.stdout.write(f"{msg}\n")
 
 
 def get_logger(verbose):
@@ -125,7 +122,10 @@ def get_logger(verbose):
             "%Y-%m-%d %H:%M:%S"
     )
 
-    syslog_handler = logging.handlers.SysLogHandler(address="/dev/log")
+    # pulls in socket, pickle, queue, ... - only needed with --syslog
+    from logging import handlers
+
+    syslog_handler = handlers.SysLogHandler(address="/dev/log")
     syslog_handler.setFormatter(syslog_formatter)
     syslog_handler.setLevel(syslog_level)
     logger.addHandler(syslog_handler)
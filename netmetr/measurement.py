@@ -1,9 +1,11 @@
+import collections
+import functools
 import json
+import lzma
 import os
-import shlex
+import re
 import subprocess
 import tempfile
-import time
 
 from .exceptions import MeasurementError
 from .logging import logger
@@ -16,6 +18,33 @@ SPEED_RESULT_REQUIRED_FIELDS = {
     "res_ul_throughput_kbps",
 }
 
+# Directions in rmbt flows data and their names used by the control server
+FLOW_DIRECTIONS = (
+    ("dl", "download"),
+    ("ul", "upload"),
+)
+# minimal gap between two uploaded flow samples (ns)
+FLOW_SAMPLE_INTERVAL = 30000000
+
+# Round-trip time in a reply line of ping output, e.g. "... time=12.3 ms"
+PING_TIME_RE = re.compile(rb"time=(\d+(?:\.\d+)?) ?ms")
+
+# A down-sampled speed flow sample, kept as a tuple to keep the memory low
+# until it is serialized for the control server (see `_asdict()`)
+SpeedSample = collections.namedtuple("SpeedSample", ["direction", "thread", "time", "bytes"])
+
+
+@functools.lru_cache(maxsize=None)
+def read_sysinfo(path, default):
+    """Read the first line of a system information file. The files do not
+    change while running so each of them is read only once.
+    """
+    try:
+        with open(path, "r") as f:
+            return f.readline().strip()
+    except OSError:
+        return default
+
 
 class Measurement:
     def __init__(self, proto: Protocol, settings, bind_ip=None):
@@ -38,42 +67,28 @@ class Measurement:
             bind_ip=bind_ip
         )
 
-        if os.path.isfile("/etc/turris-version"):
-            with open("/etc/turris-version", "r") as turris_version:
-                self.os_version = turris_version.read().split("\n")[0]
-        else:
-            self.os_version = "unknown"
-
-        if os.path.isfile("/tmp/sysinfo/model"):
-            with open("/tmp/sysinfo/model", "r") as f:
-                self.model = f.read().strip()
-        else:
-            self.model = "default"
+    def __enter__(self):
+        return self
 
-        if os.path.isfile("/tmp/sysinfo/board_name"):
-            with open("/tmp/sysinfo/board_name", "r") as f:
-                self.hw_version = f.read().strip()
-        else:
-            self.hw_version = "unknown"
+    def __exit__(self, *exc_info):
+        self.speed.cleanup()
 
     def measure(self):
         ping_shortest = self.pings.measure()
         speed_results = self.speed.measure()
 
+        download_mbps = speed_results["res_dl_throughput_kbps"] / 1000
+        upload_mbps = speed_results["res_ul_throughput_kbps"] / 1000
+        ping_ms = ping_shortest / 1000000
         simple_result = {
-            "download_mbps": round(speed_results["res_dl_throughput_kbps"] / 1000, 2),
-            "upload_mbps": round(speed_results["res_ul_throughput_kbps"] / 1000, 2),
-            "ping_ms": round(ping_shortest / 1000000, 2),
+            "download_mbps": round(download_mbps, 2),
+            "upload_mbps": round(upload_mbps, 2),
+            "ping_ms": round(ping_ms, 2),
         }
 
         logger.info(
-            "{} test result: download: {:.2f}Mbps, upload: "
-            "{:.2f}Mbps, ping: {:.2f}ms".format(
-                self.proto.value,
-                speed_results["res_dl_throughput_kbps"] / 1000,
-                speed_results["res_ul_throughput_kbps"] / 1000,
-                ping_shortest / 1000000
-            )
+            f"{self.proto.value} test result: download: {download_mbps:.2f}Mbps, "
+            f"upload: {upload_mbps:.2f}Mbps, ping: {ping_ms:.2f}ms"
         )
 
         full_results = (
@@ -92,11 +107,13 @@ class Measurement:
         # See https://control.netmetr.cz/RMBTControlServer/api/v1/openapi#/default/post_result
         # for schema definition types from there are written as a comments
         # bellow
+        os_version = read_sysinfo("/etc/turris-version", "unknown")
+        hw_version = read_sysinfo("/tmp/sysinfo/board_name", "unknown")
         result = {
             "geoLocations": [],
-            "model": self.model,  # str
+            "model": read_sysinfo("/tmp/sysinfo/model", "default"),  # str
             "network_type": get_network_type(),  # int
-            "product": "os: "+self.os_version+" hw: "+self.hw_version,  # str
+            "product": f"os: {os_version} hw: {hw_version}",  # str
             "test_bytes_download": test_res.get("res_total_bytes_dl"),  # int
             "test_bytes_upload": test_res.get("res_total_bytes_ul"),  # int
             "test_nsec_download": test_res.get("res_dl_time_ns"),  # int
@@ -105,13 +122,10 @@ class Measurement:
             "test_ping_shortest": ping_shortest,  # int
             "num_threads_ul": test_res.get("res_ul_num_flows"),  # int
             "test_speed_download": test_res.get("res_dl_throughput_kbps"),  # int
-            "test_speed_upload": test_res.get(
-                "res_ul_throughput_kbps"
-            ),  # int
+            "test_speed_upload": test_res.get("res_ul_throughput_kbps"),  # int
             "test_token": self.test_token,  # str
+            "pings": [],
         }
-
-        result["pings"] = []
         return result
 
 
@@ -127,31 +141,33 @@ class PingMeasurement:
          the lowest one
         """
         ping_cmd = "ping" if self.proto == Protocol.IPv4 else "ping6"
-        command = ping_cmd
+        # Run all the pings by a single process, the replies are printed
+        # (and parsed) one per line as they arrive
+        command = [ping_cmd, "-c", str(int(self.count)), "-i", "0.5"]
         if self.bind_ip:
-            command = command + " -I " + self.bind_ip
-        command = command + " -c1 " + self.test_server_address
+            command += ["-I", self.bind_ip]
+        command.append(self.test_server_address)
         logger.progress("Starting ping test...")
-        logger.debug(f"Using ping command: {command}")
-        ping_values = list()
-        for i in range(1, int(self.count)+1):
-            process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE)
-            if (process.wait() == 0):
-                try:
-                    ping_result = process.stdout.read()
-                    start = ping_result.index(b"time=") + len("time=")
-                    end = ping_result.index(b" ms")
-                    ping = float(ping_result[start:end])
-                    logger.output("ping_"+str(i)+"_msec = "+format(ping, ".2f"))
-                    ping = int(ping * 1000000)
-                    ping_values.append(ping)
-                except Exception as e:
-                    raise MeasurementError("Problem decoding pings: {}".format(e))
-                time.sleep(0.5)
+        logger.debug(f"Using ping command: {' '.join(command)}")
         try:
-            return min(int(s) for s in ping_values)
-        except Exception as e:
-            raise MeasurementError("Problem getting lowest ping: {}".format(e))
+            process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        except OSError as e:
+            raise MeasurementError("Ping measurement failed: {}".format(e))
+
+        ping_values = list()
+        # closes the pipe and waits for the process even if parsing fails
+        with process:
+            for ping_result in process.stdout:
+                match = PING_TIME_RE.search(ping_result)
+                if not match:
+                    continue
+                ping = float(match.group(1))
+                logger.output(f"ping_{len(ping_values) + 1}_msec = {ping:.2f}")
+                ping_values.append(int(ping * 1000000))
+
+        if not ping_values:
+            raise MeasurementError("Problem getting lowest ping: no ping reply received")
+        return min(ping_values)
 
 
 class SpeedMeasurement:
@@ -165,34 +181,34 @@ class SpeedMeasurement:
         self.numthreads = numthreads
         self.duration = duration
         self.bind_ip = bind_ip
+        # Reserve a unique name for the flows file written by rmbt-client
+        fd, self.flows_file = tempfile.mkstemp()
+        os.close(fd)
         # Create config file needed by rmbt-client
-        _, self.config_file = tempfile.mkstemp()
-        _, self.flows_file = tempfile.mkstemp()
+        self.config_file = None
         try:
-            with open(self.config_file, "w") as config_file:
-                config_file.write(
-                        '{"cnf_file_flows": "'+self.flows_file+'.xz"}'
-                )
+            with tempfile.NamedTemporaryFile("w", delete=False) as config_file:
+                self.config_file = config_file.name
+                json.dump({"cnf_file_flows": self.flows_file + ".xz"}, config_file)
         except OSError as e:
+            # raised from Measurement's constructor, its __exit__ won't run
+            self.cleanup()
             raise MeasurementError("Error creating measurement config file ({})".format(e))
-        except IOError as e:
-            raise MeasurementError("Error writing measurement config file ({})".format(e))
-
-        encryption = {True: " -e "}
-        command = (
-            RMBT_BIN +
-            encryption.get(self.encryption, "") +
-            " -h " + self.address +
-            " -c " + self.config_file +
-            " -p " + str(self.port) +
-            " -t " + self.token +
-            " -f " + self.numthreads +
-            " -d " + self.duration +
-            " -u " + self.duration
-        )
+
+        self.rmbt_command = [
+            RMBT_BIN,
+            "-h", self.address,
+            "-c", self.config_file,
+            "-p", str(self.port),
+            "-t", self.token,
+            "-f", str(self.numthreads),
+            "-d", str(self.duration),
+            "-u", str(self.duration),
+        ]
+        if self.encryption:
+            self.rmbt_command.append("-e")
         if self.bind_ip:
-            command = command + " -b " + self.bind_ip
-        self.rmbt_command = shlex.split(command)
+            self.rmbt_command += ["-b", self.bind_ip]
 
     def measure(self):
         """Start RMBT client with saved arguments to measure the speed
@@ -202,19 +218,19 @@ class SpeedMeasurement:
             process = subprocess.Popen(
                 self.rmbt_command,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+                stderr=subprocess.PIPE,
+                encoding="utf-8"
             )
 
         except OSError as e:
             raise MeasurementError("Speed measurement failed: {}".format(e))
 
-        while process.poll() is None:
-            line = process.stderr.readline()
-            if line:
-                logger.output(line.decode("utf-8").strip())
-
         try:
-            test_result = process.stdout.read().decode("utf-8")
+            with process:
+                # blocks until a whole line (or EOF) is available
+                for line in process.stderr:
+                    logger.output(line.strip())
+                test_result = process.stdout.read()
 
         except UnicodeError as e:
             raise MeasurementError(
@@ -225,7 +241,7 @@ class SpeedMeasurement:
         logger.log_result(test_result)
 
         try:
-            test_result_json = json.loads(test_result.split("}")[1] + "}")
+            test_result_json = parse_rmbt_result(test_result)
 
         except json.JSONDecodeError as e:
             raise MeasurementError(
@@ -233,59 +249,76 @@ class SpeedMeasurement:
                 "output: {}".format(e)
             ) from e
 
-        for field in SPEED_RESULT_REQUIRED_FIELDS:
-            if field not in test_result_json:
-                raise MeasurementError("Speed measurement failed: '{}' missing "
-                                       " in result".format(field))
+        missing = SPEED_RESULT_REQUIRED_FIELDS - test_result_json.keys()
+        if missing:
+            raise MeasurementError("Speed measurement failed: {} missing in result".format(
+                ", ".join(sorted(missing))
+            ))
 
         return test_result_json
 
     def import_speed_flows(self):
         """The speedtest flow is saved to a file during the test. This function
         imports it so it could be sent to the control server.
+
+        Returns a list of SpeedSample tuples or None on failure.
         """
-        directions = {
-            "dl": "download",
-            "ul": "upload"
-        }
         try:
-            subprocess.call(shlex.split("unxz -f "+self.flows_file+".xz"))
-            with open(self.flows_file, "r") as json_data:
+            # The flows are decompressed on the fly, nothing is written to disk
+            with lzma.open(self.flows_file + ".xz", "rt") as json_data:
                 flows_json = json.load(json_data)
-        except (OSError, IOError) as e:
+        except (OSError, EOFError, lzma.LZMAError, ValueError) as e:
             logger.error("Problem reading/decoding flows data: {}".format(e))
             return None
 
+        res_details = flows_json["res_details"]
         speed_array = list()
-        for d_short, d_long in directions.items():
-            if d_short not in flows_json["res_details"]:
+        append = speed_array.append
+        for d_short, d_long in FLOW_DIRECTIONS:
+            flows = res_details.get(d_short)
+            if flows is None:
                 logger.error("Direction {} not found in flows data.".format(d_long))
                 continue
 
-            thread = 0
             # Each direction has multiple threads
-            for flow in flows_json["res_details"][d_short]:
+            for thread, flow in enumerate(flows):
                 last_time = 0
                 # Each thread has plenty of samples
                 # We want to use a small amount of them
                 for sample in flow["time_series"]:
-                    if (sample.get("t") - last_time) > 30000000:
-                        last_time = sample["t"]
-                        speed_array.append({
-                            "direction": d_long,
-                            "thread": thread,
-                            "time": sample["t"],
-                            "bytes": sample["b"]
-                         })
-                thread += 1
-
-        # Remove generated files
-        try:
-            os.remove(self.flows_file)
-        except OSError as e:
-            logger.error("Failed to remove flows file: {}".format(e))
-        try:
-            os.remove(self.config_file)
-        except OSError as e:
-            logger.error("Failed to remove mesurement config file: {}".format(e))
+                    sample_time = sample["t"]
+                    if sample_time - last_time > FLOW_SAMPLE_INTERVAL:
+                        last_time = sample_time
+                        append(SpeedSample(d_long, thread, sample_time, sample["b"]))
+
         return speed_array
+
+    def cleanup(self):
+        """Remove the files generated for and by rmbt-client. The flows file
+        does not exist when the measurement failed.
+        """
+        for path in (self.flows_file, self.flows_file + ".xz", self.config_file):
+            if path is None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("Failed to remove measurement file: {}".format(e))
+
+
+def parse_rmbt_result(output):
+    """Parse the test result - the last JSON object printed by rmbt (the
+    preceding ones describe the test configuration).
+    """
+    decoder = json.JSONDecoder()
+    result = None
+    start = output.find("{")
+    while start != -1:
+        result, end = decoder.raw_decode(output, start)
+        start = output.find("{", end)
+
+    if result is None:
+        raise json.JSONDecodeError("No JSON object found", output, 0)
+    return result
@@ -9,20 +9,42 @@ from .control import ControlServer
 from .exceptions import ControlServerError, MeasurementError, ConfigError
 from .exceptions import ProgrammingError
 from .logging import logger
-from .measurement import Measurement
 from .protocols import Protocol, Mode
 
-HIST_FILE = "/tmp/netmetr-history.json"
+HIST_FILE = os.environ.get("NETMETR_HIST_FILE", "/tmp/netmetr-history.json")
+
+# protocols measured in the given mode
+MODE_PROTOCOLS = {
+    Mode.only_4: (Protocol.IPv4,),
+    Mode.only_6: (Protocol.IPv6,),
+    Mode.prefer_4: (Protocol.IPv4,),
+    Mode.prefer_6: (Protocol.IPv6,),
+    Mode.both: (Protocol.IPv4, Protocol.IPv6),
+}
+# the unpreferred protocol tried when the preferred one fails
+FALLBACK_PROTOCOL = {
+    Mode.prefer_4: Protocol.IPv6,
+    Mode.prefer_6: Protocol.IPv4,
+}
 
 
 def save_history(history):
-    _, hist_file = tempfile.mkstemp()
+    tmp_file = None
     try:
-        with open(hist_file, "w") as f:
-            f.write(json.dumps(history, indent=2))
-        os.rename(hist_file, HIST_FILE)
+        # write next to the final file, so it can be atomically replaced
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(HIST_FILE), delete=False
+        ) as f:
+            tmp_file = f.name
+            json.dump(history, f, indent=2)
+        os.replace(tmp_file, HIST_FILE)
     except OSError as e:
         logger.error("Error saving measurement history: {}".format(e))
+        if tmp_file is not None:
+            try:
+                os.unlink(tmp_file)
+            except FileNotFoundError:
+                pass
 
 
 class Netmetr:
@@ -34,6 +56,16 @@ class Netmetr:
             use_tls=not unsecure
         )
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the connections kept open to the control server"""
+        self.control_server.close()
+
     def get_uuid(self):
         return self.control_server.uuid
 
@@ -89,23 +121,16 @@ class Netmetr:
         """
         measured = False
         result = {}
-        proto_map = {
-            Protocol.IPv4: [Mode.only_4, Mode.both, Mode.prefer_4],
-            Protocol.IPv6: [Mode.only_6, Mode.both, Mode.prefer_6]
-        }
 
         # try to run the measurements
-        for proto, protocol_modes in proto_map.items():
-            if protocol_mode in protocol_modes:
-                m, result[proto] = self._run_measurement(proto)
-                measured = m or measured
+        for proto in MODE_PROTOCOLS[protocol_mode]:
+            m, result[proto] = self._run_measurement(proto)
+            measured = m or measured
 
         # if all of them failed, try running the unpreferred option
-        if not measured:
-            if protocol_mode == Mode.prefer_4:
-                _, result[Protocol.IPv6] = self._run_measurement(Protocol.IPv6)
-            elif protocol_mode == Mode.prefer_6:
-                _, result[Protocol.IPv4] = self._run_measurement(Protocol.IPv4)
+        if not measured and protocol_mode in FALLBACK_PROTOCOL:
+            proto = FALLBACK_PROTOCOL[protocol_mode]
+            _, result[proto] = self._run_measurement(proto)
 
         return result
 
@@ -168,12 +193,15 @@ class Netmetr:
         if proto is None:
             raise ConfigError("Measurement protocol is not specified")
 
+        # imported only when really measuring (lzma, subprocess, ...)
+        from .measurement import Measurement
+
         logger.progress(f"Preparing for {proto.value} measurement...")
         with self.control_server.use_proto(proto):
             test_settings = self.control_server.request_settings()
 
-            measurement = Measurement(proto, test_settings, bind_ip=bind_ip)
-            simple_result, full_results = measurement.measure()
+            with Measurement(proto, test_settings, bind_ip=bind_ip) as measurement:
+                simple_result, full_results = measurement.measure()
             self.control_server.upload_result(*full_results)
             return simple_result
 
@@ -21,8 +21,10 @@ def _line_is_default_route(fields):
 def get_network_type():
     try:
         with open("/proc/net/route") as fh:
+            next(fh, None)  # skip the header
             for line in fh:
-                fields = line.strip().split()
+                # only Iface, Destination, Gateway and Flags are needed
+                fields = line.split(None, 4)
                 if _line_is_default_route(fields):
                     if MOBILE_PREFIX in fields[0]:
                         return NETWORK_TYPE_MOBILE
@@ -18,15 +18,7 @@ class Mode(enum.Enum):
 
 
 def get_proto_mode(string):
-    if string == "only_4":
-        return Mode.only_4
-    if string == "only_6":
-        return Mode.only_6
-    if string == "prefer_4":
-        return Mode.prefer_4
-    if string == "prefer_6":
-        return Mode.prefer_6
-    if string == "both":
-        return Mode.both
-
-    raise ConfigError("Not a valid protocol mode: {}".format(string))
+    try:
+        return Mode[string]
+    except KeyError:
+        raise ConfigError("Not a valid protocol mode: {}".format(string)) from None
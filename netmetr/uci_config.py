@@ -41,11 +41,12 @@ class Config(dict):
                 else:
                     log_option_used(option, value)
 
-                if need_to_commit:
-                    self.uci.commit(CONFIG)
-
                 super().__setitem__(option, value)
 
+        # all the missing options are written by a single commit
+        if need_to_commit:
+            self.uci.commit(CONFIG)
+
     def __setitem__(self, option, value):
         if self.get(option) == value:
             return
@@ -0,0 +1,103 @@
+import http.server
+import json
+import socket
+import threading
+import time
+import unittest
+
+from netmetr.control import ControlServer
+from netmetr.logging import logger
+from netmetr.measurement import SpeedSample
+
+IDLE_TIMEOUT = 0.5
+
+
+class IdleClosingHandler(http.server.BaseHTTPRequestHandler):
+    """Keep-alive control server stub which closes connections idle for more
+    than IDLE_TIMEOUT - it sends FIN but still accepts what the client writes,
+    as a real server behind a slow link appears to the client.
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = IDLE_TIMEOUT
+
+    def handle(self):
+        self.close_connection = False
+        while not self.close_connection:
+            self.handle_one_request()
+
+        try:
+            self.connection.shutdown(socket.SHUT_WR)
+            self.connection.settimeout(2)
+            while self.connection.recv(65536):
+                pass
+        except OSError:
+            pass
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        body = b""
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return body
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def do_POST(self):
+        req = json.loads(self._read_body())
+        self.server.requests.append((self.path, req))
+        host = self.headers["Host"]
+        if "settings" in self.path:
+            rep = {"settings": [{"uuid": "uuid-1", "urls": {
+                "control_ipv4_only": host, "control_ipv6_only": host
+            }}]}
+        elif "sync" in self.path:
+            rep = {"sync": [{"sync_code": "sync-1"}]}
+        else:
+            rep = {}
+
+        body = json.dumps(rep).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestControlServerConnections(unittest.TestCase):
+    def setUp(self):
+        logger.set(False, False, False, True)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), IdleClosingHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        address = "127.0.0.1:{}".format(self.server.server_address[1])
+        self.control = ControlServer(address, use_tls=False)
+
+    def tearDown(self):
+        self.control.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_request_after_idle_timeout(self):
+        time.sleep(IDLE_TIMEOUT * 3)
+        self.assertEqual(self.control.download_sync_code(), "sync-1")
+
+    def test_upload_after_idle_timeout(self):
+        samples = [SpeedSample("download", 0, 40000000, 4000), SpeedSample("upload", 1, 80000000, 8000)]
+        time.sleep(IDLE_TIMEOUT * 3)
+        self.control.upload_result({"test_token": "token-1"}, samples)
+
+        uploads = [req for path, req in self.server.requests if path.endswith("/result")]
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(uploads[0]["test_token"], "token-1")
+        self.assertEqual(uploads[0]["speed_detail"], [sample._asdict() for sample in samples])
+
+
+if __name__ == "__main__":
+    unittest.main()